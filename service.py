@@ -0,0 +1,271 @@
+# asyncio facing front end for the solver, for embedding it behind a request
+# handler without blocking the event loop or printing to stdout.
+#
+# deals are queued by priority (lower values run first, ties in arrival order)
+# and solved on an executor, a process pool by default since solving is CPU
+# bound. identical deals submitted while one is already waiting, queued or
+# running share that one solve, and every solve has a state budget so a hard
+# deal gives up instead of holding a worker forever.
+#
+# backpressure: at most max_pending deals are queued for the workers. past
+# that, new deals wait for room in a waiting room, still in priority order, so
+# an urgent deal overtakes everything that hasn't been queued yet. the waiting
+# room holds at most max_waiting deals, a new deal arriving when it is full is
+# refused straight away with QueueFull rather than piling up more work.
+#
+# cancelling a caller only cancels its own wait. once nobody is waiting on a
+# solve any more it is dropped: taken out of the queue or waiting room (freeing
+# its slot) if it hasn't started, or told to stop through its cancel event if
+# it is running, which try_solve notices within STOP_CHECK_INTERVAL states.
+# closing the service fails every unfinished solve with ServiceClosed.
+import asyncio
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor
+from heapq import heapify, heappop, heappush
+from itertools import count
+from multiprocessing import Manager
+from multiprocessing.managers import SyncManager
+from typing import Callable, NamedTuple, Optional, Protocol
+
+from solver import BudgetExceeded, Card, GameState, SolveCancelled, noop_output, try_solve
+
+Deal = tuple[tuple[Card, ...], ...]
+
+class QueueFull(RuntimeError):
+    pass
+
+class ServiceClosed(RuntimeError):
+    pass
+
+class SolveResult(NamedTuple):
+    solved: bool
+    moves: list[str] # descriptions of the moves to play, in order
+    states: int # number of states visited
+    exhausted: bool # the state budget ran out before an answer was found
+
+class CancelEvent(Protocol):
+    # threading.Event, or a Manager().Event() proxy to reach another process
+    def is_set(self) -> bool: ...
+    def set(self) -> None: ...
+
+SolveFn = Callable[[Deal, Optional[int], CancelEvent], SolveResult]
+
+def to_deal(stacks:list[list[Card]]) -> Deal:
+    return tuple(map(tuple, stacks))
+
+def solve_deal(deal:Deal, max_states:Optional[int], cancel:CancelEvent) -> SolveResult:
+    # runs in the worker process, so it only takes and returns picklable values.
+    # raises SolveCancelled once cancel is set
+    gs = GameState(list(map(list, deal)))
+    gs.update_foundations()
+
+    visited:set[str] = set()
+    moves:list[str] = []
+
+    try:
+        solved = try_solve(gs, noop_output, visited=visited, max_states=max_states,
+                           solution_fn=moves.extend, stop_fn=cancel.is_set)
+    except BudgetExceeded:
+        return SolveResult(False, [], len(visited), True)
+
+    return SolveResult(solved, moves, len(visited), False)
+
+class Job:
+    def __init__(self, key:tuple[Deal, Optional[int]], future:"asyncio.Future[SolveResult]"):
+        self.key = key
+        self.future = future
+        self.waiters = 0
+        # set while the job sits in the queue or the waiting room
+        self.item:Optional[tuple[int, int, Job]] = None
+        self.admitted = False
+        # only made once a worker takes the job, so waiting jobs stay cheap
+        self.cancel:Optional[CancelEvent] = None
+        self.running = False
+
+QueueItem = tuple[int, int, Job]
+
+class SolverService:
+    def __init__(self, workers:int = 4, max_pending:int = 64, max_waiting:int = 256,
+                 max_states:Optional[int] = 1_000_000, executor:Optional[Executor] = None,
+                 solve_fn:SolveFn = solve_deal):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_waiting = max_waiting
+        self.max_states = max_states
+        self.executor = executor
+        self.owns_executor = executor is None
+        self.solve_fn = solve_fn
+        self.manager:Optional[SyncManager] = None
+        self.inflight:dict[tuple[Deal, Optional[int]], Job] = {}
+        self.sequence = count()
+        # heaps rather than asyncio.PriorityQueues, so that abandoned jobs can be
+        # taken out again
+        self.queue:list[QueueItem] = []
+        self.waiting_room:list[QueueItem] = []
+        self.ready:Optional[asyncio.Event] = None
+        self.tasks:list[asyncio.Task[None]] = []
+        # pending cancel event updates, kept so they aren't garbage collected
+        self.stopping:set[asyncio.Task[None]] = set()
+        # number of solves that were stopped partway through
+        self.stopped = 0
+
+    async def start(self) -> None:
+        if self.ready is not None:
+            raise TypeError("service already started")
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(self.workers)
+        if isinstance(self.executor, ProcessPoolExecutor):
+            # cancel events have to be shared with the worker processes
+            self.manager = await asyncio.to_thread(Manager)
+        self.ready = asyncio.Event()
+        self.tasks = [asyncio.create_task(self.work()) for _ in range(self.workers)]
+
+    async def close(self) -> None:
+        # take the jobs first, the workers forget their running jobs once stopped
+        jobs = list(self.inflight.values())
+        self.inflight.clear()
+        self.queue.clear()
+        self.waiting_room.clear()
+
+        for job in jobs:
+            job.item = None
+            if not job.future.done():
+                job.future.set_exception(ServiceClosed("solver service closed"))
+
+        for t in self.tasks:
+            t.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        self.ready = None
+
+        for job in jobs:
+            self.stop(job)
+        await asyncio.gather(*self.stopping)
+
+        if self.owns_executor and self.executor is not None:
+            # running solves stop on their own once they see their cancel event
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+        if self.manager is not None:
+            await asyncio.to_thread(self.manager.shutdown)
+            self.manager = None
+
+    async def __aenter__(self) -> "SolverService":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc:object) -> None:
+        await self.close()
+
+    def pending(self) -> int:
+        return len(self.queue)
+
+    def waiting(self) -> int:
+        return len(self.waiting_room)
+
+    async def solve(self, stacks:list[list[Card]], priority:int = 0, max_states:Optional[int] = None) -> SolveResult:
+        # raises QueueFull if this is a new deal and there is no room left for it
+        if self.ready is None:
+            raise TypeError("service must be started")
+
+        budget = max_states if max_states is not None else self.max_states
+        key = (to_deal(stacks), budget)
+        job = self.inflight.get(key)
+
+        if job is None:
+            if len(self.queue) >= self.max_pending and len(self.waiting_room) >= self.max_waiting:
+                raise QueueFull(f"{self.max_pending} deals queued and {self.max_waiting} waiting")
+
+            job = Job(key, asyncio.get_running_loop().create_future())
+            self.inflight[key] = job
+            job.item = (priority, next(self.sequence), job)
+            heappush(self.waiting_room, job.item)
+            self.admit()
+
+        job.waiters += 1
+        try:
+            return await asyncio.shield(job.future)
+        except asyncio.CancelledError:
+            self.release(job)
+            raise
+
+    def admit(self) -> None:
+        # move the most urgent waiting jobs into the queue while it has room
+        assert self.ready is not None
+        while len(self.waiting_room) > 0 and len(self.queue) < self.max_pending:
+            item = heappop(self.waiting_room)
+            item[2].admitted = True
+            heappush(self.queue, item)
+            self.ready.set()
+
+    def release(self, job:Job) -> None:
+        # a waiter went away, drop the job once nobody wants its result
+        job.waiters -= 1
+        if job.waiters == 0:
+            if self.inflight.get(job.key) is job:
+                del self.inflight[job.key]
+            job.future.cancel()
+            self.stop(job)
+
+            if job.item is not None:
+                heap = self.queue if job.admitted else self.waiting_room
+                heap.remove(job.item)
+                heapify(heap)
+                job.item = None
+                self.admit()
+
+    def stop(self, job:Job) -> None:
+        # stops the solve if a worker already has it, setting a Manager event is
+        # a round trip to the manager process so it's done off the event loop
+        if job.cancel is None:
+            return
+        if self.manager is None:
+            job.cancel.set()
+        else:
+            t = asyncio.create_task(asyncio.to_thread(job.cancel.set))
+            self.stopping.add(t)
+            t.add_done_callback(self.stopping.discard)
+
+    async def make_cancel(self) -> CancelEvent:
+        if self.manager is None:
+            return threading.Event()
+        return await asyncio.to_thread(self.manager.Event)
+
+    async def work(self) -> None:
+        assert self.ready is not None
+        ready = self.ready
+        loop = asyncio.get_running_loop()
+
+        while True:
+            while len(self.queue) == 0:
+                ready.clear()
+                await ready.wait()
+
+            (_, _, job) = heappop(self.queue)
+            job.item = None
+            self.admit()
+
+            try:
+                cancel = await self.make_cancel()
+                job.cancel = cancel
+                # dropped while the event was being made
+                if job.future.done():
+                    continue
+
+                job.running = True
+                (deal, budget) = job.key
+                try:
+                    result = await loop.run_in_executor(self.executor, self.solve_fn, deal, budget, cancel)
+                except SolveCancelled as e:
+                    self.stopped += 1
+                    if not job.future.done():
+                        job.future.set_exception(e)
+                except Exception as e:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+                else:
+                    if not job.future.done():
+                        job.future.set_result(result)
+            finally:
+                if self.inflight.get(job.key) is job:
+                    del self.inflight[job.key]
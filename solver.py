@@ -7,8 +7,11 @@
 # * 4 suit foundations: all start with ace in play, build upward in order, ending with K
 #
 # valid moves: always 1 card at a time, matching types (movement of all "stacked" items at once to an empty stack may be worth representing)
+from hashlib import blake2b
+from mmap import mmap
 from random import randrange
-from typing import Callable, Optional, TypeVar
+from tempfile import TemporaryFile
+from typing import IO, Callable, NoReturn, Optional, Protocol, TypeVar
 
 SEGMENT = 16
 suits = ["Thorns", "Goblets", "Swords", "Coins"]
@@ -29,6 +32,9 @@ foundations = list(map(lambda n: n * 16 + 1, range(0, len(suits))))
 foundations.append(TAROT_BASE - 1)
 foundations.append(TAROT_COUNT + TAROT_BASE)
 
+# every Card int (including the two tarot foundation placeholders) is below this
+CARD_RANGE = TAROT_COUNT + TAROT_BASE + 1
+
 Card = int
 
 def make_card(rank: str, suit: str) -> Card:
@@ -49,11 +55,14 @@ def make_deck() -> list[Card]:
 
     return cards
 
+# suit, is_tarot and short_card look their answers up in the tables below,
+# falling back to the arithmetic for ints outside the card range
+
 def suit(n:Card) -> int:
-    return n // SEGMENT
+    return SUITS[n] if 0 <= n < CARD_RANGE else n // SEGMENT
 
 def is_tarot(n:Card) -> bool:
-    return suit(n) >= len(suits)
+    return TAROTS[n] if 0 <= n < CARD_RANGE else suit(n) >= len(suits)
 
 def card(n:Card) -> tuple[str, str]:
     d = suit(n)
@@ -64,6 +73,9 @@ def card(n:Card) -> tuple[str, str]:
         return (str(n - TAROT_BASE), TAROT_NAME)
 
 def short_card(n:Card) -> str:
+    return SHORT_CARDS[n] if 0 <= n < CARD_RANGE else make_short_card(n)
+
+def make_short_card(n:Card) -> str:
     if n == TAROT_BASE - 1 or n == TAROT_COUNT + TAROT_BASE:
         return ""
     (r, s) = card(n)
@@ -75,6 +87,17 @@ def short_card(n:Card) -> str:
 def playable_on(c1:Card, c2:Card) -> bool:
     return abs(c1 - c2) == 1
 
+# lookup tables indexed by Card, so the solver's inner loops don't redo the
+# arithmetic (or the string building for short_card) on every call
+SUITS = [n // SEGMENT for n in range(CARD_RANGE)]
+TAROTS = [s >= len(suits) for s in SUITS]
+# "" for the ints that aren't cards (and the tarot foundation placeholders)
+SHORT_CARDS = [make_short_card(n) if TAROTS[n] or 1 <= n % SEGMENT <= len(ranks) else ""
+               for n in range(CARD_RANGE)]
+# the cards each card is playable_on, also the only cards that can go onto a
+# foundation with that card on top
+NEIGHBOURS = [tuple(c for c in (n - 1, n + 1) if 0 <= c < CARD_RANGE) for n in range(CARD_RANGE)]
+
 def top_sequence_len(cs:list[Card]) -> int:
     n = 1
     while len(cs) > n and playable_on(cs[-n], cs[-(n+1)]):
@@ -130,8 +153,18 @@ MoveItem = tuple[ZeroParamFunction, ZeroParamFunction, str]
 class GameState:
     def __init__(self, stacks:list[list[Card]]):
         self.foundations = list(map(lambda f: [f], foundations))
-        self.stacks = stacks
+        # copied so the caller's lists can't change under runs
+        self.stacks = [list(s) for s in stacks]
         self.stash:Optional[Card] = None
+        # runs[i][k] is the top_sequence_len of stacks[i][:k + 1], kept up to date
+        # by push and pop so moves don't have to rescan the stacks. stacks must
+        # only change through push and pop to keep the two in step
+        self.runs:list[list[int]] = []
+        for s in self.stacks:
+            r:list[int] = []
+            for k, c in enumerate(s):
+                self.extend_run(r, s[k - 1] if k > 0 else None, c)
+            self.runs.append(r)
 
     def __repr__(self) -> str:
         return (SEPARATOR +
@@ -144,17 +177,35 @@ class GameState:
         canon_stacks = sorted(filter(lambda t: len(t) > 0, self.stacks), key=lambda t: t[0])
         return repr({'stacks': canon_stacks, 'stash': self.stash})
 
+    @staticmethod
+    def extend_run(r:list[int], below:Optional[Card], c:Card) -> None:
+        # add the run length for c going on top of below
+        r.append(r[-1] + 1 if below is not None and playable_on(c, below) else 1)
+
+    def push(self, si:int, c:Card) -> None:
+        s = self.stacks[si]
+        self.extend_run(self.runs[si], s[-1] if len(s) > 0 else None, c)
+        s.append(c)
+
+    def pop(self, si:int) -> Card:
+        self.runs[si].pop()
+        return self.stacks[si].pop()
+
+    def tops(self) -> dict[Card, int]:
+        # index of the stack holding each top card
+        return {s[-1]: i for i, s in enumerate(self.stacks) if len(s) > 0}
+
     def update_foundations(self) -> ZeroParamFunction:
         # generate a list of updates to apply to move cards from stacks to foundations, each
         # update is like a move (below): a pair of functions, one to perform the move and the
         # other to undo it (to do all updates, the undo has to be done in reverse order)
 
         def move_top_to_foundation(si:int, fi:int) -> None:
-            self.foundations[fi].append(self.stacks[si].pop())
+            self.foundations[fi].append(self.pop(si))
 
         def return_to_stack(si:int, fi:int) -> ZeroParamFunction:
             def fn() -> None:
-                self.stacks[si].append(self.foundations[fi].pop())
+                self.push(si, self.foundations[fi].pop())
             return fn
         
         def return_to_stash(fi:int) -> ZeroParamFunction:
@@ -163,20 +214,28 @@ class GameState:
             return fn
 
         updates:list[ZeroParamFunction] = []
+        tops = self.tops()
 
         while True:
             start = len(updates)
             for j, f in enumerate(self.foundations):
-                if self.stash is not None and playable_on(self.stash, f[-1]):
-                    self.foundations[j].append(self.stash)
-                    self.stash = None
-                    updates.append(return_to_stash(j))
-
-                for i, s in enumerate(self.stacks):
-                    if len(s) > 0:
-                        if (self.stash is None or is_tarot(s[-1])) and playable_on(s[-1], f[-1]):
-                            move_top_to_foundation(i, j)
-                            updates.append(return_to_stack(i, j))
+                # only the neighbours of the foundation top can be played on it,
+                # so look those up rather than checking every stack
+                for c in NEIGHBOURS[f[-1]]:
+                    if c == self.stash:
+                        self.foundations[j].append(self.stash)
+                        self.stash = None
+                        updates.append(return_to_stash(j))
+                        break
+
+                    i = tops.get(c)
+                    if i is not None and (self.stash is None or is_tarot(c)):
+                        move_top_to_foundation(i, j)
+                        updates.append(return_to_stack(i, j))
+                        del tops[c]
+                        if len(self.stacks[i]) > 0:
+                            tops[self.stacks[i][-1]] = i
+                        break
 
             # continue until no more moves exist
             if len(updates) == start:
@@ -193,12 +252,12 @@ class GameState:
     def move_to_stash(self, si:int) -> None:
         if self.stash is not None:
             raise TypeError("stash must not have a value")
-        self.stash = self.stacks[si].pop()
+        self.stash = self.pop(si)
 
     def pop_stash(self, si:int) -> None:
         if self.stash is None:
             raise TypeError("stash must have a value")
-        self.stacks[si].append(self.stash)
+        self.push(si, self.stash)
         self.stash = None
 
     def is_solved(self) -> bool:
@@ -231,17 +290,16 @@ class GameState:
 
         # for stack to stack moves of multiple items in one go (common play pattern)
         def move_stack_top_and_undo(i: int, j:int) -> MoveItem:
-            n = top_sequence_len(self.stacks[i])
+            n = self.runs[i][-1]
 
+            # moving the sequence card by card reverses it, same as take_sequence
             def fn() -> None:
-                taken = take_sequence(self.stacks[i])
-                self.stacks[j] += taken
+                for _ in range(n):
+                    self.push(j, self.pop(i))
 
             def undo() -> None:
-                taken = self.stacks[j][-n:]
-                taken.reverse()
-                del self.stacks[j][-n:]
-                self.stacks[i] += taken
+                for _ in range(n):
+                    self.push(i, self.pop(j))
 
             return (fn, undo, f"move items from stack {i + 1} to {j + 1}")
 
@@ -272,14 +330,17 @@ class GameState:
                 if len(t) > 0:
                     moves.append(move_empty_pair(i))
 
-        # collect moves of top cards
+        # collect moves of top cards, looking up the stacks topped by a neighbour
+        # of each top instead of checking every pair of stacks
+        tops = self.tops()
         for i, s1 in enumerate(self.stacks):
-            for j, s2 in enumerate(self.stacks):
-                # only consider each pair once, but since playable_on is always symmetric, each
-                # found pair implies two possible (but opposite) moves
-                if i > j and len(s1) > 0 and len(s2) > 0 and playable_on(s1[-1], s2[-1]):
-                    moves.append(move_stack_top_and_undo(i, j))
-                    moves.append(move_stack_top_and_undo(j, i))
+            if len(s1) > 0:
+                for j in sorted(tops[c] for c in NEIGHBOURS[s1[-1]] if c in tops):
+                    # only consider each pair once, but since playable_on is always symmetric, each
+                    # found pair implies two possible (but opposite) moves
+                    if i > j:
+                        moves.append(move_stack_top_and_undo(i, j))
+                        moves.append(move_stack_top_and_undo(j, i))
 
         return moves
 
@@ -289,7 +350,107 @@ OutputFn = Callable[[str], None]
 def noop_output(s:str) -> None:
     pass
 
-def try_solve(gs:GameState, out_fn:OutputFn = print, verbose_fn:Optional[OutputFn] = None) -> bool:
+class VisitedSet(Protocol):
+    # the membership interface try_solve needs for its visited states, a plain
+    # set[str] satisfies it
+    def __contains__(self, rep:object) -> bool: ...
+    def __len__(self) -> int: ...
+    def add(self, rep:str) -> None: ...
+
+class DiskVisitedSet:
+    # an open-addressing hash table kept in a memory-mapped temporary file, so
+    # the visited states of a long search can grow past physical memory (the
+    # OS pages the table in and out instead of the process being killed)
+    #
+    # only a fixed size digest of each state_rep is stored, not the rep itself;
+    # with 128-bit digests a false "already visited" is vanishingly unlikely.
+    # an all zero slot marks an empty entry, linear probing resolves collisions
+    # and the table doubles (into a new file) when it gets half full.
+    KEY_SIZE = 16
+
+    def __init__(self, capacity:int = 1 << 16, directory:Optional[str] = None):
+        self.directory = directory
+        self.count = 0
+        self.slots = 1
+        while self.slots < capacity:
+            self.slots *= 2
+        (self.file, self.table) = self._allocate(self.slots)
+
+    def _allocate(self, slots:int) -> tuple[IO[bytes], mmap]:
+        f = TemporaryFile(dir=self.directory)
+        f.truncate(slots * self.KEY_SIZE)
+        return (f, mmap(f.fileno(), slots * self.KEY_SIZE))
+
+    def _key(self, rep:str) -> bytes:
+        key = blake2b(rep.encode(), digest_size=self.KEY_SIZE).digest()
+        # reserve the all zero key to mean "empty slot"
+        return key if any(key) else b"\x01" + key[1:]
+
+    def _find(self, key:bytes) -> tuple[int, bool]:
+        # offset of the slot holding key, or of the empty slot where it belongs
+        mask = self.slots - 1
+        i = int.from_bytes(key[:8], "little") & mask
+        while True:
+            offset = i * self.KEY_SIZE
+            slot = self.table[offset:offset + self.KEY_SIZE]
+            if slot == key:
+                return (offset, True)
+            if not any(slot):
+                return (offset, False)
+            i = (i + 1) & mask
+
+    def _grow(self) -> None:
+        (old_file, old_table, old_slots) = (self.file, self.table, self.slots)
+        self.slots *= 2
+        (self.file, self.table) = self._allocate(self.slots)
+
+        for i in range(old_slots):
+            key = old_table[i * self.KEY_SIZE:(i + 1) * self.KEY_SIZE]
+            if any(key):
+                (offset, _) = self._find(key)
+                self.table[offset:offset + self.KEY_SIZE] = key
+
+        old_table.close()
+        old_file.close()
+
+    def __contains__(self, rep:object) -> bool:
+        return isinstance(rep, str) and self._find(self._key(rep))[1]
+
+    def __len__(self) -> int:
+        return self.count
+
+    def add(self, rep:str) -> None:
+        key = self._key(rep)
+        (offset, found) = self._find(key)
+        if not found:
+            self.table[offset:offset + self.KEY_SIZE] = key
+            self.count += 1
+            if self.count * 2 > self.slots:
+                self._grow()
+
+    def close(self) -> None:
+        self.table.close()
+        self.file.close()
+
+    def __enter__(self) -> "DiskVisitedSet":
+        return self
+
+    def __exit__(self, *exc:object) -> None:
+        self.close()
+
+class BudgetExceeded(Exception):
+    pass
+
+class SolveCancelled(Exception):
+    pass
+
+# how many new states try_solve visits between calls to its stop_fn
+STOP_CHECK_INTERVAL = 1000
+
+def try_solve(gs:GameState, out_fn:OutputFn = print, verbose_fn:Optional[OutputFn] = None,
+              visited:Optional[VisitedSet] = None, max_states:Optional[int] = None,
+              solution_fn:Optional[Callable[[list[str]], None]] = None,
+              stop_fn:Optional[Callable[[], bool]] = None) -> bool:
     # basic solving strategy is to enumerate possible moves and try each
     # one, stashing the remaining moves for backtracking and continue
     # after each move, let foundations update, but also preserve that
@@ -298,12 +459,22 @@ def try_solve(gs:GameState, out_fn:OutputFn = print, verbose_fn:Optional[OutputF
     # to avoid loops, a set of state_rep instances (canonicalized form of
     # serialized game state) are kept to avoid returning to already visited
     # game states and getting stuck in loops). This can make the process
-    # quite memory intensive if a solution takes a long time to find.
+    # quite memory intensive if a solution takes a long time to find, pass
+    # a DiskVisitedSet as visited to keep them on disk instead. max_states
+    # bounds the search, BudgetExceeded is raised once more states than that
+    # have been visited. stop_fn is polled every STOP_CHECK_INTERVAL states
+    # and SolveCancelled is raised once it returns True. either way, all moves
+    # made so far are undone first, so like the normal outcomes gs is left as
+    # it was passed in.
+    #
+    # on success, solution_fn (if given) receives the move descriptions in
+    # the order they are played.
     #
     # This has not really been optimized yet beyond the change to treat
     # stacks of card sequences as single move operatios.
     stack:list[MovesWithUndo] = []
-    reps:set[str] = set([gs.state_rep()])
+    reps:VisitedSet = visited if visited is not None else set()
+    reps.add(gs.state_rep())
 
     def compose(um:ZeroParamFunction, undo_fd:ZeroParamFunction) -> ZeroParamFunction:
         def fn() -> None:
@@ -312,6 +483,13 @@ def try_solve(gs:GameState, out_fn:OutputFn = print, verbose_fn:Optional[OutputF
 
         return fn
 
+    def give_up(e:Exception) -> NoReturn:
+        out_fn(f"gave up! (visited {len(reps)} states)")
+        while len(stack) > 0:
+            (_, undo, _, _) = stack.pop()
+            undo()
+        raise e
+
     moves = None
 
     while True:
@@ -332,20 +510,31 @@ def try_solve(gs:GameState, out_fn:OutputFn = print, verbose_fn:Optional[OutputF
                 reps.add(rep)
                 stack.append((moves, compose(um, gs.update_foundations()), rep, desc))
                 moves = None
+
+                if max_states is not None and len(reps) > max_states:
+                    give_up(BudgetExceeded(f"visited more than {max_states} states"))
+                if stop_fn and len(reps) % STOP_CHECK_INTERVAL == 0 and stop_fn():
+                    give_up(SolveCancelled(f"stopped after {len(reps)} states"))
             else:
                 um() # undo the move and try the next one
 
         if gs.is_solved():
             out_fn(repr(gs))
             out_fn(f"success! (visited {len(reps)} states, took {len(stack)} moves)")
+            solution:list[str] = []
             while len(stack) > 0:
                 (_, undo, rep, desc) = stack.pop()
                 out_fn(desc)
+                solution.append(desc)
                 undo()
                 out_fn(repr(gs))
 
             out_fn("read solution upward from here")
 
+            if solution_fn:
+                solution.reverse()
+                solution_fn(solution)
+
             return True
 
         if len(stack) == 0:
@@ -1,5 +1,9 @@
+import asyncio
+import threading
 import unittest
+import service
 import solver
+from concurrent.futures import ThreadPoolExecutor
 from typing import Callable, Optional
 
 CardDesc = tuple[str, str]
@@ -7,6 +11,24 @@ CardDesc = tuple[str, str]
 def stack_of(cards:list[CardDesc]) -> list[solver.Card]:
     return list(map(lambda c: solver.make_card(*c), cards))
 
+# a deal that takes well over a thousand states to search
+def hard_deal() -> list[list[solver.Card]]:
+    stacks = list(map(solver.parse_cards, map(solver.to_stack, [
+        '7/ 8* 9 3v 13 10* 6',
+        '21 5 3t 3* 12 7* 5t',
+        '2t 15 8v 4 Jv 6* 14',
+        '4t 4v 10/ Qv 2* 9t 7t',
+        '20 19 Q/ Qt 6/ 3/ 6t',
+        '10t 0 18 7v 2v 5v 2',
+        'J* 8/ 7 11 K* Jt 9*',
+        '10v 5/ Kt 9/ Q* 5* 8t',
+        '10 K/ J/ 3 1 2/ 4*',
+        'Kv 8 4/ 17 9v 6v 16',
+    ])))
+    stacks.insert(5, [])
+
+    return stacks
+
 class TestCardCreation(unittest.TestCase):
     def test_make_card(self) -> None:
         for rank in solver.ranks:
@@ -57,6 +79,23 @@ class TestCardCreation(unittest.TestCase):
         for (c1, c2, res) in cases:
             self.assertEqual(solver.playable_on(solver.make_card(*c1), solver.make_card(*c2)), res)
 
+    def test_lookup_tables(self) -> None:
+        for n in range(solver.CARD_RANGE):
+            self.assertEqual(solver.suit(n), n // solver.SEGMENT)
+            for c in range(solver.CARD_RANGE):
+                self.assertEqual(c in solver.NEIGHBOURS[n], solver.playable_on(n, c))
+
+        for n in solver.make_deck():
+            self.assertEqual(solver.short_card(n), solver.make_short_card(n))
+
+        # ints that aren't cards don't pick up a name, and outside the tables
+        # the arithmetic still applies
+        self.assertEqual(solver.short_card(0), "")
+        self.assertEqual(solver.short_card(solver.TAROT_BASE - 1), "")
+        self.assertEqual(solver.suit(-1), -1)
+        self.assertFalse(solver.is_tarot(-1))
+        self.assertTrue(solver.is_tarot(solver.CARD_RANGE))
+
     def test_take_full_sequence(self) -> None:
         cards = ["5/", "6/", "7/"]
         arr = solver.parse_cards(cards)
@@ -118,6 +157,35 @@ class TestCardCreation(unittest.TestCase):
 
         self.assertEqual(before, repr(gs))
 
+    def assertRunsMatch(self, gs:solver.GameState) -> None:
+        for s, r in zip(gs.stacks, gs.runs):
+            self.assertListEqual(r, [solver.top_sequence_len(s[:k + 1]) for k in range(len(s))])
+
+    def test_runs_follow_moves(self) -> None:
+        stacks = [
+            solver.parse_cards(["5v", "8", "7", "6"]),
+            solver.parse_cards(["9", "3*"]),
+            solver.parse_cards(["4v"]),
+            [],
+        ]
+
+        gs = solver.GameState(stacks)
+        self.assertListEqual(gs.runs[0], [1, 1, 2, 3])
+
+        # changes to the caller's lists don't reach the game state
+        stacks[0].pop()
+        self.assertListEqual(gs.stacks[0], solver.parse_cards(["5v", "8", "7", "6"]))
+        self.assertRunsMatch(gs)
+
+        for (do_move, undo_move, _) in gs.all_moves():
+            do_move()
+            self.assertRunsMatch(gs)
+            undo = gs.update_foundations()
+            self.assertRunsMatch(gs)
+            undo()
+            undo_move()
+            self.assertRunsMatch(gs)
+
     def confirm_trivial_solve(self, gs:solver.GameState) -> None:
         before = repr(gs)
         undo = gs.update_foundations()
@@ -206,6 +274,33 @@ class TestCardCreation(unittest.TestCase):
         # without a free stack, these cannot be cleared
         self.assertFalse(solver.try_solve(gs, solver.noop_output))
 
+    def test_budget_exceeded(self) -> None:
+        gs = solver.GameState(hard_deal())
+        gs.update_foundations()
+        before = repr(gs)
+
+        with self.assertRaises(solver.BudgetExceeded):
+            solver.try_solve(gs, solver.noop_output, max_states=10)
+
+        # giving up undoes the partial search
+        self.assertEqual(before, repr(gs))
+
+    def test_stop_fn(self) -> None:
+        gs = solver.GameState(hard_deal())
+        gs.update_foundations()
+        before = repr(gs)
+        calls:list[int] = []
+
+        def stop() -> bool:
+            calls.append(1)
+            return len(calls) == 2
+
+        with self.assertRaises(solver.SolveCancelled):
+            solver.try_solve(gs, solver.noop_output, stop_fn=stop)
+
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(before, repr(gs))
+
     def test_blocked_stash(self) -> None:
         stacks = [
             stack_of([("2", "Thorns"), ("11", solver.TAROT_NAME)]),
@@ -268,6 +363,283 @@ class TestCardCreation(unittest.TestCase):
 
         self.assertEqual(rep, gs.state_rep())
 
+class TestDiskVisitedSet(unittest.TestCase):
+    def test_membership(self) -> None:
+        with solver.DiskVisitedSet(capacity=4) as visited:
+            reps = [f"state {n}" for n in range(100)]
+            for rep in reps:
+                self.assertFalse(rep in visited)
+                visited.add(rep)
+                self.assertTrue(rep in visited)
+
+            # adding again does not count twice, and growth keeps every entry
+            visited.add(reps[0])
+            self.assertEqual(len(visited), len(reps))
+            self.assertGreater(visited.slots, 4)
+            for rep in reps:
+                self.assertTrue(rep in visited)
+            self.assertFalse("state 100" in visited)
+
+    def test_disk_backed_solve(self) -> None:
+        stacks = [
+            stack_of([("2", "Thorns"), ("3", "Goblets"), ("3", "Coins"), ("4", "Coins")]),
+            stack_of([("2", "Coins"), ("2", "Goblets"), ("3", "Thorns"), ("5", "Coins")]),
+            stack_of([("4", "Thorns"), ("4", "Goblets"), ("6", "Coins")]),
+            []
+        ]
+
+        gs = solver.GameState(stacks)
+        gs.update_foundations()
+        with solver.DiskVisitedSet(capacity=2) as visited:
+            self.assertTrue(solver.try_solve(gs, solver.noop_output, visited=visited))
+            self.assertGreater(len(visited), 1)
+
+class StandInSolver:
+    # takes the place of solve_deal so tests control when and how solves finish
+    def __init__(self) -> None:
+        self.calls:list[service.Deal] = []
+        self.cancelled:list[service.Deal] = []
+        self.release = threading.Event()
+        self.entered = threading.Semaphore(0)
+
+    def __call__(self, deal:service.Deal, max_states:Optional[int], cancel:service.CancelEvent) -> service.SolveResult:
+        self.calls.append(deal)
+        self.entered.release()
+        while not self.release.wait(0.001):
+            if cancel.is_set():
+                self.cancelled.append(deal)
+                raise solver.SolveCancelled()
+
+        return service.SolveResult(True, [], len(deal), False)
+
+class TestSolverService(unittest.IsolatedAsyncioTestCase):
+    def make_service(self, solve_fn:service.SolveFn = service.solve_deal, workers:int = 1,
+                     max_pending:int = 8, max_waiting:int = 8) -> service.SolverService:
+        executor = ThreadPoolExecutor(workers)
+        self.addCleanup(executor.shutdown)
+        return service.SolverService(workers, max_pending, max_waiting, executor=executor, solve_fn=solve_fn)
+
+    async def started(self, stand_in:StandInSolver) -> None:
+        # wait for the next call to stand_in to begin
+        self.assertTrue(await asyncio.to_thread(stand_in.entered.acquire, True, 5))
+
+    async def until(self, pred:Callable[[], bool]) -> None:
+        async def poll() -> None:
+            while not pred():
+                await asyncio.sleep(0)
+
+        await asyncio.wait_for(poll(), 5)
+
+    async def test_solve(self) -> None:
+        stacks = [
+            stack_of([("2", "Thorns"), ("3", "Goblets"), ("3", "Coins"), ("4", "Coins")]),
+            stack_of([("2", "Coins"), ("2", "Goblets"), ("3", "Thorns"), ("5", "Coins")]),
+            stack_of([("4", "Thorns"), ("4", "Goblets"), ("6", "Coins")]),
+            []
+        ]
+
+        async with self.make_service() as svc:
+            result = await svc.solve(stacks)
+
+        self.assertTrue(result.solved)
+        self.assertFalse(result.exhausted)
+        self.assertGreater(len(result.moves), 0)
+        self.assertGreater(result.states, 1)
+
+    async def test_impossible_and_exhausted(self) -> None:
+        impossible = [stack_of([("2", "Thorns"), ("3", "Thorns")])]
+
+        async with self.make_service() as svc:
+            result = await svc.solve(impossible)
+            self.assertFalse(result.solved)
+            self.assertFalse(result.exhausted)
+
+            result = await svc.solve(hard_deal(), max_states=10)
+            self.assertFalse(result.solved)
+            self.assertTrue(result.exhausted)
+
+    async def test_dedupes_identical_deals(self) -> None:
+        stand_in = StandInSolver()
+        deal = [[1, 2], [3]]
+
+        async with self.make_service(stand_in) as svc:
+            waiting = [asyncio.create_task(svc.solve(deal)) for _ in range(3)]
+            await self.started(stand_in)
+            stand_in.release.set()
+            results = await asyncio.gather(*waiting)
+
+        self.assertEqual(len(stand_in.calls), 1)
+        for r in results:
+            self.assertIs(r, results[0])
+
+    async def test_dedupes_while_queue_full(self) -> None:
+        stand_in = StandInSolver()
+
+        async with self.make_service(stand_in, max_pending=1) as svc:
+            blocker = asyncio.create_task(svc.solve([[0]]))
+            await self.started(stand_in)
+            queued = asyncio.create_task(svc.solve([[1]]))
+            await self.until(lambda: svc.pending() == 1)
+
+            # the queue is full, these all share one job waiting for room
+            waiting = [asyncio.create_task(svc.solve([[2]])) for _ in range(3)]
+            key = (service.to_deal([[2]]), svc.max_states)
+            await self.until(lambda: key in svc.inflight and svc.inflight[key].waiters == 3)
+            self.assertEqual(svc.pending(), 1)
+            self.assertEqual(svc.waiting(), 1)
+
+            stand_in.release.set()
+            await asyncio.gather(blocker, queued)
+            results = await asyncio.gather(*waiting)
+
+        self.assertListEqual(stand_in.calls, [((0,),), ((1,),), ((2,),)])
+        for r in results:
+            self.assertIs(r, results[0])
+
+    async def test_priority_order(self) -> None:
+        stand_in = StandInSolver()
+
+        async with self.make_service(stand_in) as svc:
+            # occupy the only worker so the rest queue up
+            blocker = asyncio.create_task(svc.solve([[0]]))
+            await self.started(stand_in)
+            waiting = [asyncio.create_task(svc.solve([[p]], priority=p)) for p in [3, 1, 2]]
+            await self.until(lambda: svc.pending() == 3)
+            stand_in.release.set()
+            await asyncio.gather(blocker, *waiting)
+
+        self.assertListEqual(stand_in.calls, [((0,),), ((1,),), ((2,),), ((3,),)])
+
+    async def test_priority_while_queue_full(self) -> None:
+        stand_in = StandInSolver()
+
+        async with self.make_service(stand_in, max_pending=1) as svc:
+            blocker = asyncio.create_task(svc.solve([[0]]))
+            await self.started(stand_in)
+            waiting = [asyncio.create_task(svc.solve([[n]], priority=10)) for n in range(1, 5)]
+            await self.until(lambda: svc.pending() == 1 and svc.waiting() == 3)
+
+            # overtakes everything still in the waiting room
+            urgent = asyncio.create_task(svc.solve([[99]], priority=-100))
+            await self.until(lambda: svc.waiting() == 4)
+
+            stand_in.release.set()
+            await asyncio.gather(blocker, urgent, *waiting)
+
+        self.assertListEqual(stand_in.calls, [((0,),), ((1,),), ((99,),), ((2,),), ((3,),), ((4,),)])
+
+    async def test_queue_full(self) -> None:
+        stand_in = StandInSolver()
+
+        async with self.make_service(stand_in, max_pending=1, max_waiting=1) as svc:
+            blocker = asyncio.create_task(svc.solve([[0]]))
+            await self.started(stand_in)
+            queued = asyncio.create_task(svc.solve([[1]]))
+            waiting = asyncio.create_task(svc.solve([[2]]))
+            await self.until(lambda: svc.pending() == 1 and svc.waiting() == 1)
+
+            # no room for another deal, but identical deals still share a job
+            with self.assertRaises(service.QueueFull):
+                await svc.solve([[3]])
+            same = asyncio.create_task(svc.solve([[2]]))
+
+            stand_in.release.set()
+            results = await asyncio.gather(blocker, queued, waiting, same)
+
+        self.assertIs(results[2], results[3])
+        self.assertListEqual(stand_in.calls, [((0,),), ((1,),), ((2,),)])
+
+    async def test_close_fails_waiters(self) -> None:
+        stand_in = StandInSolver()
+        svc = self.make_service(stand_in, max_pending=1)
+        await svc.start()
+
+        running = asyncio.create_task(svc.solve([[0]]))
+        await self.started(stand_in)
+        queued = asyncio.create_task(svc.solve([[1]]))
+        waiting = asyncio.create_task(svc.solve([[2]]))
+        await self.until(lambda: svc.pending() == 1 and svc.waiting() == 1)
+
+        await svc.close()
+
+        for t in [running, queued, waiting]:
+            with self.assertRaises(service.ServiceClosed):
+                await t
+            self.assertFalse(t.cancelled())
+
+        # the running solve was told to stop
+        await self.until(lambda: len(stand_in.cancelled) > 0)
+        self.assertListEqual(stand_in.cancelled, [((0,),)])
+
+    async def test_cancel_queued_frees_slot(self) -> None:
+        stand_in = StandInSolver()
+
+        async with self.make_service(stand_in, max_pending=1) as svc:
+            blocker = asyncio.create_task(svc.solve([[0]]))
+            await self.started(stand_in)
+            queued = asyncio.create_task(svc.solve([[1]]))
+            await self.until(lambda: svc.pending() == 1)
+
+            # the queue is full, so this submitter has to wait for room
+            blocked = asyncio.create_task(svc.solve([[2]]))
+            await self.until(lambda: len(svc.inflight) == 3)
+            self.assertFalse(blocked.done())
+
+            # cancelled before it started, its slot goes to the blocked deal
+            # straight away and it is never solved
+            queued.cancel()
+            await self.until(lambda: svc.pending() == 1 and svc.queue[0][2].key[0] == ((2,),))
+
+            stand_in.release.set()
+            await asyncio.gather(blocker, blocked)
+            with self.assertRaises(asyncio.CancelledError):
+                await queued
+
+        self.assertListEqual(stand_in.calls, [((0,),), ((2,),)])
+
+    async def test_cancel_running_frees_worker(self) -> None:
+        stand_in = StandInSolver()
+
+        async with self.make_service(stand_in) as svc:
+            running = asyncio.create_task(svc.solve([[0]]))
+            await self.started(stand_in)
+            queued = asyncio.create_task(svc.solve([[1]]))
+            await self.until(lambda: svc.pending() == 1)
+
+            # the abandoned solve stops, so the next one starts without waiting
+            running.cancel()
+            await self.started(stand_in)
+            self.assertListEqual(stand_in.cancelled, [((0,),)])
+
+            stand_in.release.set()
+            await queued
+            with self.assertRaises(asyncio.CancelledError):
+                await running
+
+        self.assertListEqual(stand_in.calls, [((0,),), ((1,),)])
+
+    async def test_default_executor(self) -> None:
+        # the production setup: a process pool, with cancel events shared
+        # through a Manager
+        async with service.SolverService(workers=1, max_states=None) as svc:
+            result = await svc.solve([stack_of([("2", "Thorns"), ("3", "Thorns")])])
+            self.assertFalse(result.solved)
+            self.assertFalse(result.exhausted)
+
+            hard = asyncio.create_task(svc.solve(hard_deal()))
+            key = (service.to_deal(hard_deal()), None)
+            await self.until(lambda: key in svc.inflight and svc.inflight[key].running)
+
+            # with one worker the next solve can only run once the hard one has
+            # seen its cancel event in the worker process and stopped
+            hard.cancel()
+            result = await asyncio.wait_for(svc.solve([stack_of([("2", "Coins")]), []]), 30)
+            self.assertTrue(result.solved)
+            self.assertEqual(svc.stopped, 1)
+
+            with self.assertRaises(asyncio.CancelledError):
+                await hard
+
 if __name__ == "__main__":
     unittest.main()
 